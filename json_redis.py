@@ -1,289 +1,1020 @@
 import json
 import os
+import re
+import sys
 import time
+import atexit
+import bisect
+import heapq
+import pickle
+import struct
 import fnmatch
+import contextlib
+import functools
+import itertools
 import threading
+from collections import deque
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# fdatasync skips the metadata flush but is missing on macOS and Windows.
+_fdatasync = getattr(os, 'fdatasync', os.fsync)
+
+
+def _fsync_dir(path):
+    """Make a rename into ``path``'s directory durable. Directories cannot be opened on Windows."""
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+# Number of lock stripes the keyspace is split into; must be a power of two.
+_STRIPES = 64
+
+# Snapshots are {'version': ..., 'generation': ..., 'ttl': {...}} plus one key -> value section per
+# type. Unversioned snapshots are the flat key -> value dict written before the log existed.
+_SNAPSHOT_VERSION = 2
+
+# Logs start with a magic marker and the generation of the compaction they continue from.
+# Each record is a little-endian u32 payload length and the JSON payload [opcode, *args].
+_AOF_HEADER = struct.Struct('<6sQ')
+_AOF_MAGIC = b'JRAOF\x01'
+_RECORD_HEADER = struct.Struct('<I')
+
+# Commands are logged by their index in this tuple rather than by name.
+_AOF_OPS = ('set', 'delete', 'sadd', 'srem', 'hset', 'hdel', 'hincrby', 'lpush', 'rpush', 'lpop', 'rpop',
+            'expireat', 'incrby', 'rename', 'append', 'zadd')
+_AOF_OPCODES = {name: code for code, name in enumerate(_AOF_OPS)}
+
+# Type tags stored in JSONStorage._type; they index the _shards tuple and the tables below.
+# _T_OTHER holds anything else set() is given (floats, None, ...), which type() reports as 'unknown'.
+_T_STRING, _T_INTEGER, _T_LIST, _T_SET, _T_HASH, _T_ZSET, _T_OTHER = range(7)
+_TYPE_NAMES = ('string', 'integer', 'list', 'set', 'hash', 'zset', 'unknown')
+_TYPE_TAGS = {name: tag for tag, name in enumerate(_TYPE_NAMES)}
+_DESCRIPTIONS = ('a string', 'an integer', 'a list', 'a set', 'a hash', 'a sorted set', 'a value of another type')
+
+
+def _check_member(key, member):
+    # JSON turns a tuple into a list, which could not be a set member or hash field again on load.
+    if member is not None and not isinstance(member, (str, int, float)):
+        raise TypeError(f"Members of key '{key}' must be strings or numbers, not {type(member).__name__}.")
+
+
+def _dumps(obj):
+    """Encode ``obj`` as JSON bytes, converting sets, deques and sorted sets during traversal."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, default=_default, option=orjson.OPT_NON_STR_KEYS)
+        except orjson.JSONEncodeError:
+            # orjson rejects integers outside 64 bits, and would read them back as floats. The
+            # stdlib handles them; its output is marked with a leading space (still valid JSON)
+            # so _loads knows to decode it with the stdlib too.
+            return b' ' + json.dumps(obj, default=_default).encode()
+    return json.dumps(obj, default=_default).encode()
+
+
+def _loads(data):
+    if orjson is not None and data[:1] != b' ':
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+class SortedSet:
+    """Sorted set members kept ordered by (score, member), with O(1) score lookups."""
+
+    __slots__ = ('_items', '_scores')
+
+    def __init__(self, pairs=()):
+        self._scores = {member: score for score, member in pairs}
+        self._items = sorted((score, member) for member, score in self._scores.items())
+
+    def add(self, score, member):
+        if member in self._scores:
+            old_score = self._scores[member]
+            if old_score == score:
+                return
+            # Insert first: comparing members of mismatched types raises here, before anything changed.
+            bisect.insort(self._items, (score, member))
+            del self._items[bisect.bisect_left(self._items, (old_score, member))]
+        else:
+            bisect.insort(self._items, (score, member))
+        self._scores[member] = score
+
+    def score(self, member):
+        return self._scores.get(member)
+
+    def range(self, start, end):
+        return [member for _, member in self._items[start:end + 1]]
+
+    def __len__(self):
+        return len(self._items)
+
+    def __iter__(self):
+        return iter(self._items)
+
+
+def _default(obj):
+    """JSON fallback for the container types the encoders do not know, applied as they are reached."""
+    if isinstance(obj, SortedSet):
+        # Already a list of (score, member) pairs; hand it over without copying.
+        return obj._items
+    if isinstance(obj, (set, deque)):
+        return list(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+# Rebuild container types that JSON flattens to arrays, indexed by type tag.
+_DECODERS = (None, None, deque, set, None, SortedSet, None)
+
+
+def _decode(kind, value):
+    # Pickled sets, deques and sorted sets come back as they were; only JSON arrays need rebuilding.
+    decode = _DECODERS[kind]
+    return decode(value) if decode and isinstance(value, list) else value
+
+
+def _is_pickle(data):
+    # Pickles start with the PROTO opcode, which no JSON document does, so a store can change fmt.
+    return data[:1] == b'\x80'
+
+
+@functools.lru_cache(maxsize=256)
+def _glob_matcher(pattern):
+    """Compiled match function for a glob, reused across keys() calls with the same pattern."""
+    return re.compile(fnmatch.translate(pattern)).match
+
+
+def _intern(key):
+    """Share one string object per key across _type, the shards, ttl and the expiry heap."""
+    return sys.intern(key) if type(key) is str else key
+
+
+_KINDS = {
+    str: _T_STRING, int: _T_INTEGER, list: _T_LIST, deque: _T_LIST,
+    set: _T_SET, dict: _T_HASH, SortedSet: _T_ZSET,
+}
+
+
+def _kind_of(value):
+    """Type tag of the shard a value written with set() is stored in."""
+    kind = _KINDS.get(type(value))
+    if kind is not None:
+        return kind
+    # Subclasses (bool, OrderedDict, ...) miss the exact-type probe.
+    if isinstance(value, (list, deque)):
+        return _T_LIST
+    elif isinstance(value, set):
+        return _T_SET
+    elif isinstance(value, dict):
+        return _T_HASH
+    elif isinstance(value, SortedSet):
+        return _T_ZSET
+    elif isinstance(value, int):
+        return _T_INTEGER
+    elif isinstance(value, str):
+        return _T_STRING
+    return _T_OTHER
+
+
+class RWLock:
+    """Read-preferring reader-writer lock.
+
+    Any number of readers may hold it at once; a writer waits until they have
+    all left. The write side is reentrant, and the thread holding it may also
+    take the read side, so writers can call reader methods. Readers must not
+    try to upgrade to the write side. Used as a context manager it takes the
+    write side.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = None
+        self._writer_depth = 0
+
+    def acquire_read(self):
+        with self._cond:
+            if self._writer != threading.get_ident():
+                while self._writer is not None:
+                    self._cond.wait()
+            self._readers += 1
+
+    def release_read(self):
+        with self._cond:
+            self._readers -= 1
+            if not self._readers:
+                self._cond.notify_all()
+
+    def acquire_write(self):
+        me = threading.get_ident()
+        with self._cond:
+            if self._writer == me:
+                self._writer_depth += 1
+                return
+            while self._writer is not None or self._readers:
+                self._cond.wait()
+            self._writer = me
+            self._writer_depth = 1
+
+    def release_write(self):
+        with self._cond:
+            self._writer_depth -= 1
+            if not self._writer_depth:
+                self._writer = None
+                self._cond.notify_all()
+
+    def __enter__(self):
+        self.acquire_write()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release_write()
+
+
+# Point reads that look the key up in one dict and probe what they find once (exists, type,
+# sismember, scard, hget, hlen, llen, lindex, zscore) take no lock at all: under the GIL
+# neither step can observe a half-applied write. Readers that iterate a container or, like
+# get(), combine lookups in several dicts keep @_reader.
+def _reader(method):
+    @functools.wraps(method)
+    def wrapper(self, key, *args, **kwargs):
+        lock = self._stripe(key)
+        lock.acquire_read()
+        try:
+            return method(self, key, *args, **kwargs)
+        finally:
+            lock.release_read()
+    return wrapper
+
+
+def _writer(method):
+    @functools.wraps(method)
+    def wrapper(self, key, *args, **kwargs):
+        lock = self._stripe(key)
+        lock.acquire_write()
+        try:
+            return method(self, key, *args, **kwargs)
+        finally:
+            lock.release_write()
+    return wrapper
+
 
 class JSONStorage:
-    def __init__(self, filename='storage.json'):
+    def __init__(self, filename='storage.json', snapshot_interval=60, snapshot_ops=10000, appendfsync='everysec',
+                 fmt='json'):
+        if appendfsync not in ('always', 'everysec', 'no'):
+            raise ValueError(f"Unknown appendfsync policy '{appendfsync}'.")
+        if fmt not in ('json', 'pickle'):
+            raise ValueError(f"Unknown snapshot format '{fmt}'.")
         self.filename = filename
-        self.lock = threading.RLock()
+        # 'pickle' snapshots keep sets, deques and sorted sets as-is and are faster to
+        # write and load, but are Python-only and must come from a trusted source.
+        self.fmt = fmt
+        self.aof_filename = filename + '.aof'
+        self.patch_filename = filename + '.part'
+        self.snapshot_interval = snapshot_interval
+        self.snapshot_ops = snapshot_ops
+        self.appendfsync = appendfsync
+        self.stripes = [RWLock() for _ in range(_STRIPES)]
+        self._aof_lock = threading.Lock()
+        self._ops = 0
+        self._dirty = set()
+        self._batch = None
+        self._replaying = False
+        self._closing = False
+        self._failure = None
+        self._snapshot_due = threading.Event()
+        self._expire_wakeup = threading.Event()
+        self._ttl_lock = threading.Lock()
+        # One dict per value type; _type maps every live key to the type tag of the shard holding it.
+        self.strings = {}
+        self.ints = {}
+        self.lists = {}
+        self.sets = {}
+        self.hashes = {}
+        self.zsets = {}
+        self.others = {}
+        self.ttl = {}
+        self._type = {}
+        self._shards = (self.strings, self.ints, self.lists, self.sets, self.hashes, self.zsets, self.others)
         self._load_storage()
+        self.aof = open(self.aof_filename, 'ab', buffering=1 << 20)
+        if self.aof.tell() == 0:
+            self.aof.write(self._aof_header())
+        self._snapshot_thread = threading.Thread(target=self._snapshot_loop, daemon=True)
+        self._snapshot_thread.start()
+        self._expire_thread = threading.Thread(target=self._expire_loop, daemon=True)
+        self._expire_thread.start()
+        atexit.register(self.close)
+
+    def _stripe(self, key):
+        return self.stripes[hash(key) & (_STRIPES - 1)]
+
+    @contextlib.contextmanager
+    def _locked(self, *keys, write=False):
+        """Hold the stripes covering ``keys``, or every stripe when none are given.
+
+        Stripes are always taken in index order so multi-key commands cannot deadlock.
+        """
+        if keys:
+            locks = [self.stripes[i] for i in sorted({hash(key) & (_STRIPES - 1) for key in keys})]
+        else:
+            locks = self.stripes
+        for lock in locks:
+            lock.acquire_write() if write else lock.acquire_read()
+        try:
+            yield
+        finally:
+            for lock in reversed(locks):
+                lock.release_write() if write else lock.release_read()
 
     def _load_storage(self):
-        with self.lock:
+        with self._locked(write=True):
+            # Every compaction gets the next generation number, and the log records the one it
+            # continues from, so a log already folded into a snapshot or patch is not replayed again.
+            self._generation = 0
+            self._snapshot_generation = 0
+            self._snapshot_bytes = 0
+            self._patch_bytes = 0
+            self._keys_sorted = None
             if os.path.exists(self.filename):
-                with open(self.filename, 'r') as file:
-                    self.storage = json.load(file)
-                    for key, value in self.storage.items():
-                        if isinstance(value, list) and all(isinstance(item, (int, str)) for item in value):
-                            self.storage[key] = set(value)
-            else:
-                self.storage = {}
+                with open(self.filename, 'rb') as file:
+                    data = file.read()
+                snapshot = self._decode(data)
+                if snapshot.get('version') == _SNAPSHOT_VERSION:
+                    self._generation = self._snapshot_generation = snapshot['generation']
+                    self._restore(snapshot)
+                else:
+                    self._restore_legacy(snapshot)
+                self._snapshot_bytes = len(data)
+            self._apply_patches()
+            self._ttl_heap = []
+            self._replay_aof()
+            self._ttl_heap = [(expires_at, key) for key, expires_at in self.ttl.items()]
+            heapq.heapify(self._ttl_heap)
+
+    def _encode(self, obj):
+        if self.fmt == 'pickle':
+            return pickle.dumps(obj, protocol=5)
+        return _dumps(obj)
+
+    def _decode(self, data):
+        if _is_pickle(data):
+            return pickle.loads(data)
+        return _loads(data)
+
+    def _restore(self, snapshot):
+        for kind, shard in enumerate(self._shards):
+            for key, value in snapshot[_TYPE_NAMES[kind]].items():
+                key = _intern(key)
+                self._type[key] = kind
+                shard[key] = _decode(kind, value)
+        for key, expires_at in snapshot['ttl'].items():
+            self.ttl[_intern(key)] = expires_at
+
+    def _restore_legacy(self, values):
+        """Load a flat snapshot, where any array of scalars was a set and any array of pairs a sorted set."""
+        for key, value in values.items():
+            expires_at = None
+            if isinstance(value, dict) and 'expires_at' in value:
+                value, expires_at = value['value'], value['expires_at']
+            if isinstance(value, list) and all(isinstance(item, (int, str)) for item in value):
+                value = set(value)
+            elif isinstance(value, list) and value and all(isinstance(item, list) and len(item) == 2 for item in value):
+                value = SortedSet(value)
+            self._put(key, _kind_of(value), value)
+            if expires_at is not None:
+                self.ttl[key] = expires_at
+
+    def _read_patches(self, file):
+        """Yield each complete patch with the file offset just past it."""
+        # A torn last patch means the crash came before the log was truncated, so the log still covers it.
+        if _is_pickle(file.peek(1)):
+            while True:
+                try:
+                    yield pickle.load(file), file.tell()
+                except (EOFError, pickle.UnpicklingError):
+                    return
+        else:
+            end = 0
+            for line in file:
+                if not line.endswith(b'\n'):
+                    return
+                try:
+                    patch = _loads(line)
+                except ValueError:
+                    return
+                end += len(line)
+                yield patch, end
+
+    def _apply_patches(self):
+        if not os.path.exists(self.patch_filename):
+            return
+        with open(self.patch_filename, 'rb+') as file:
+            end = 0
+            for patch, end in self._read_patches(file):
+                if patch['base'] != self._snapshot_generation:
+                    # Left behind by a crash between installing a newer snapshot and removing them.
+                    continue
+                for key in patch['del']:
+                    self._drop(key)
+                for key, (name, value, expires_at) in patch['set'].items():
+                    kind = _TYPE_TAGS[name]
+                    self._put(key, kind, _decode(kind, value))
+                    if expires_at is not None:
+                        self.ttl[key] = expires_at
+                self._generation = patch['generation']
+            # Drop a torn last patch so the next one is not appended behind it.
+            file.truncate(end)
+            file.seek(0)
+            if end and _is_pickle(file.read(1)) != (self.fmt == 'pickle'):
+                # Written in the other format; make the next compaction a full snapshot, which removes them.
+                end = max(end, self._snapshot_bytes)
+        self._patch_bytes = end
+
+    def _aof_header(self):
+        return _AOF_HEADER.pack(_AOF_MAGIC, self._generation)
+
+    def _replay_aof(self):
+        if not os.path.exists(self.aof_filename):
+            return
+        self._replaying = True
+        try:
+            with open(self.aof_filename, 'rb+') as file:
+                end = 0
+                header = file.read(_AOF_HEADER.size)
+                # A torn header means nothing was logged after it.
+                if len(header) == _AOF_HEADER.size:
+                    magic, generation = _AOF_HEADER.unpack(header)
+                    if magic == _AOF_MAGIC and generation >= self._generation:
+                        end = self._replay_records(file)
+                # Drop the torn tail, or a log from an older generation whose truncation never
+                # reached disk, so new records are not appended behind it.
+                file.truncate(end)
+        finally:
+            self._replaying = False
+
+    def _replay_records(self, file):
+        """Apply every complete record and return the offset just past the last one."""
+        commands = [getattr(self, name) for name in _AOF_OPS]
+        commands[_AOF_OPCODES['set']] = self._replay_set
+        read, unpack, size = file.read, _RECORD_HEADER.unpack, _RECORD_HEADER.size
+        end = file.tell()
+        while True:
+            # A torn last record from a crash mid-append; everything before it is intact.
+            header = read(size)
+            if len(header) < size:
+                break
+            length, = unpack(header)
+            payload = read(length)
+            if len(payload) < length:
+                break
+            op, *args = _loads(payload)
+            commands[op](*args)
+            end += size + length
+        return end
+
+    def _replay_set(self, key, kind, value):
+        # JSON logs sets, lists and sorted sets as arrays.
+        self.set(key, _decode(kind, value))
+
+    def _record(self, op, *args):
+        """Encode a log record before the command changes anything, so a value the log cannot hold is rejected first."""
+        # Replayed commands are dirty too: the next compaction truncates the log they came from.
+        self._dirty.add(args[0])
+        if op == 'rename':
+            self._dirty.add(args[1])
+        if self._replaying:
+            return None
+        if self._failure is not None:
+            raise RuntimeError(f"Persisting '{self.filename}' failed; writes are refused until it succeeds.") from self._failure
+        payload = _dumps([_AOF_OPCODES[op], *args])
+        return _RECORD_HEADER.pack(len(payload)) + payload
+
+    def _log(self, record):
+        if record is None:
+            return
+        if self._batch is not None:
+            self._batch.append(record)
+        else:
+            self._write_log(record, 1, self.appendfsync == 'always')
+
+    def _write_log(self, data, count, sync):
+        with self._aof_lock:
+            self.aof.write(data)
+            if sync:
+                self._sync_aof()
+            self._ops += count
+            if self._ops >= self.snapshot_ops:
+                self._snapshot_due.set()
 
     def _save_storage(self):
-        with self.lock:
-            with open(self.filename, 'w') as file:
-                json.dump({k: list(v) if isinstance(v, set) else v for k, v in self.storage.items()}, file)
-
+        """Compact the log into the patch file, or into a fresh snapshot once the patches outgrow it."""
+        with self._locked(write=True), self._aof_lock:
+            if self.aof.closed:
+                return
+            generation = self._generation + 1
+            if self._patch_bytes < self._snapshot_bytes:
+                self._write_patch(generation)
+            else:
+                self._write_snapshot(generation)
+            self._generation = generation
+            self.aof.truncate(0)
+            self.aof.write(self._aof_header())
+            # Whatever the appendfsync policy, the emptied log must reach disk before new records follow it.
+            self.aof.flush()
+            _fdatasync(self.aof.fileno())
+            self._ops = 0
+            self._dirty.clear()
+
+    def _write_patch(self, generation):
+        patch = {'base': self._snapshot_generation, 'generation': generation, 'set': {}, 'del': []}
+        for key in self._dirty:
+            kind = self._type.get(key)
+            if kind is not None:
+                patch['set'][key] = [_TYPE_NAMES[kind], self._shards[kind][key], self.ttl.get(key)]
+            else:
+                patch['del'].append(key)
+        record = self._encode(patch)
+        if self.fmt == 'json':
+            record += b'\n'
+        with open(self.patch_filename, 'ab') as file:
+            file.write(record)
+            file.flush()
+            # The log is truncated right after this, so the patch must be on disk first.
+            _fdatasync(file.fileno())
+        self._patch_bytes += len(record)
+
+    def _write_snapshot(self, generation):
+        data = self._encode({'version': _SNAPSHOT_VERSION, 'generation': generation, 'ttl': self.ttl,
+                             **dict(zip(_TYPE_NAMES, self._shards))})
+        # Write aside and rename over, so a crash leaves either the old or the new snapshot, never a torn one.
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'wb') as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp, self.filename)
+        _fsync_dir(self.filename)
+        self._snapshot_generation = generation
+        # Patches still on disk after a crash here extend the old generation and are skipped on load.
+        if os.path.exists(self.patch_filename):
+            os.remove(self.patch_filename)
+        self._snapshot_bytes = len(data)
+        self._patch_bytes = 0
+
+    def _sync_aof(self):
+        # Callers hold _aof_lock.
+        if self.aof.closed:
+            return
+        self.aof.flush()
+        if self.appendfsync != 'no':
+            _fdatasync(self.aof.fileno())
+
+    def _snapshot_loop(self):
+        last_snapshot = time.time()
+        while True:
+            self._snapshot_due.wait(1)
+            self._snapshot_due.clear()
+            if self._closing:
+                return
+            try:
+                if self._ops and (self._ops >= self.snapshot_ops or time.time() - last_snapshot >= self.snapshot_interval):
+                    self._save_storage()
+                    last_snapshot = time.time()
+                else:
+                    # One write + fdatasync per tick covers every command appended since the last one.
+                    with self._aof_lock:
+                        self._sync_aof()
+            except Exception as exc:
+                # Keep ticking so a passing failure (ENOSPC, EIO) is retried, and refuse writes
+                # meanwhile rather than let callers believe they are reaching disk.
+                self._failure = exc
+            else:
+                self._failure = None
+
+    def _schedule_expiry(self, key, expires_at):
+        with self._ttl_lock:
+            heapq.heappush(self._ttl_heap, (expires_at, key))
+            if self._ttl_heap[0][0] == expires_at:
+                # New earliest deadline; cut the sweeper's current sleep short.
+                self._expire_wakeup.set()
+
+    def _expire_loop(self):
+        """Delete keys once their TTL passes instead of waiting for a get() to notice.
+
+        Heap entries are not removed when a key is overwritten or its TTL changes;
+        _delete_expired re-checks the stored deadline, so stale entries are no-ops.
+        """
+        while not self._closing:
+            now = time.time()
+            due = []
+            with self._ttl_lock:
+                while self._ttl_heap and self._ttl_heap[0][0] < now:
+                    due.append(heapq.heappop(self._ttl_heap)[1])
+                timeout = min(1, self._ttl_heap[0][0] - now) if self._ttl_heap else 1
+            for key in due:
+                try:
+                    self._delete_expired(key)
+                except RuntimeError:
+                    # Writes are refused until persistence recovers; try this key again later.
+                    self._schedule_expiry(key, now + 1)
+            self._expire_wakeup.wait(timeout)
+            self._expire_wakeup.clear()
+
+    def close(self):
+        with self._locked(write=True):
+            if self._closing:
+                return
+            self._closing = True
+            if self._ops:
+                self._save_storage()
+            with self._aof_lock:
+                self._sync_aof()
+                self.aof.close()
+        self._snapshot_due.set()
+        self._expire_wakeup.set()
+
+    @contextlib.contextmanager
+    def pipeline(self):
+        """Run a batch of commands under one lock acquisition and one log write.
+
+        Every stripe is held for the duration of the block, so no other thread's
+        commands are interleaved with the batch, though lock-free point reads
+        such as exists() can observe it half done. Its log records are buffered
+        and written and synced together on exit. Commands are not rolled back if
+        one raises::
+
+            with db.pipeline():
+                db.rpush('queue', 'job')
+                db.hincrby('stats', 'queued', 1)
+        """
+        with self._locked(write=True):
+            if self._batch is not None:
+                # Nested pipeline; the outer one flushes.
+                yield self
+                return
+            self._batch = []
+            try:
+                yield self
+            finally:
+                batch, self._batch = self._batch, None
+                if batch:
+                    self._write_log(b''.join(batch), len(batch), True)
+
+    def execute(self, commands):
+        """Apply ``(name, *args)`` tuples in one pipeline and return their results in order."""
+        with self.pipeline():
+            return [getattr(self, name)(*args) for name, *args in commands]
+
+    def _put(self, key, kind, value):
+        """Store ``value`` as the whole of ``key``, replacing any previous value and its TTL."""
+        old_kind = self._type.get(key)
+        if old_kind is None:
+            key = _intern(key)
+            self._keys_sorted = None
+        elif old_kind != kind:
+            del self._shards[old_kind][key]
+        self._type[key] = kind
+        self._shards[kind][key] = value
+        self.ttl.pop(key, None)
+        return value
+
+    def _drop(self, key):
+        kind = self._type.pop(key, None)
+        if kind is None:
+            return False
+        del self._shards[kind][key]
+        self.ttl.pop(key, None)
+        self._keys_sorted = None
+        return True
+
+    def _typed(self, key, kind, factory):
+        """Return the value at ``key`` if it has type tag ``kind``, creating it with ``factory`` if the key is missing."""
+        current = self._type.get(key)
+        if current is None:
+            return self._put(key, kind, factory())
+        if current != kind:
+            raise TypeError(f"The value for key '{key}' is not {_DESCRIPTIONS[kind]}.")
+        return self._shards[kind][key]
+
+    @_writer
     def set(self, key, value):
-        with self.lock:
-            self.storage[key] = value
-            self._save_storage()
-
+        if isinstance(value, (set, dict)):
+            for member in value:
+                _check_member(key, member)
+        kind = _kind_of(value)
+        record = self._record('set', key, kind, value)
+        self._put(key, kind, value)
+        self._log(record)
+
+    @_writer
     def setex(self, key, ttl, value):
-        with self.lock:
-            self.storage[key] = {'value': value, 'expires_at': time.time() + ttl}
-            self._save_storage()
+        self.set(key, value)
+        self.expireat(key, time.time() + ttl)
 
     def get(self, key):
-        with self.lock:
-            item = self.storage.get(key)
-            if isinstance(item, dict) and 'expires_at' in item:
-                if time.time() > item['expires_at']:
-                    del self.storage[key]
-                    self._save_storage()
-                    return None
-                return item['value']
-            return item
-
+        value, expired = self._get(key)
+        if expired:
+            # Readers cannot upgrade, so the expired key is dropped under a separate write lock.
+            self._delete_expired(key)
+        return value
+
+    @_reader
+    def _get(self, key):
+        kind = self._type.get(key)
+        if kind is None:
+            return None, False
+        # Only keys with a TTL pay for a clock read; most keys never touch time.time().
+        expires_at = self.ttl.get(key)
+        if expires_at is not None and time.time() > expires_at:
+            return None, True
+        value = self._shards[kind][key]
+        # Lists are kept as deques and sorted sets as SortedSet; hand back the lists they used to be.
+        if isinstance(value, (deque, SortedSet)):
+            value = list(value)
+        return value, False
+
+    @_writer
+    def _delete_expired(self, key):
+        if self._closing:
+            return
+        expires_at = self.ttl.get(key)
+        if expires_at is not None and time.time() > expires_at:
+            record = self._record('delete', key)
+            self._drop(key)
+            self._log(record)
+
+    @_writer
     def delete(self, key):
-        with self.lock:
-            if key in self.storage:
-                del self.storage[key]
-                self._save_storage()
+        if key in self._type:
+            record = self._record('delete', key)
+            self._drop(key)
+            self._log(record)
 
+    @_writer
     def sadd(self, key, value):
-        with self.lock:
-            if key not in self.storage:
-                self.storage[key] = set()
-            elif not isinstance(self.storage[key], set):
-                raise TypeError(f"The value for key '{key}' is not a set.")
-            self.storage[key].add(value)
-            self._save_storage()
+        _check_member(key, value)
+        record = self._record('sadd', key, value)
+        self._typed(key, _T_SET, set).add(value)
+        self._log(record)
 
+    @_writer
     def srem(self, key, value):
-        with self.lock:
-            if key in self.storage and value in self.storage[key]:
-                self.storage[key].remove(value)
-                self._save_storage()
+        members = self.sets.get(key)
+        if members is not None and value in members:
+            record = self._record('srem', key, value)
+            members.remove(value)
+            self._log(record)
 
     def sismember(self, key, value):
-        with self.lock:
-            return key in self.storage and value in self.storage[key]
+        members = self.sets.get(key)
+        return members is not None and value in members
 
+    @_reader
     def smembers(self, key):
-        with self.lock:
-            if key in self.storage:
-                return self.storage[key]
-            return set()
+        members = self.sets.get(key)
+        return members if members is not None else set()
 
+    @_writer
     def hset(self, key, field, value):
-        with self.lock:
-            if key not in self.storage:
-                self.storage[key] = {}
-            self.storage[key][field] = value
-            self._save_storage()
+        _check_member(key, field)
+        record = self._record('hset', key, field, value)
+        self._typed(key, _T_HASH, dict)[field] = value
+        self._log(record)
 
     def hget(self, key, field):
-        with self.lock:
-            if key in self.storage and field in self.storage[key]:
-                return self.storage[key][field]
-            return None
+        fields = self.hashes.get(key)
+        return fields.get(field) if fields is not None else None
 
+    @_writer
     def hdel(self, key, field):
-        with self.lock:
-            if key in self.storage and field in self.storage[key]:
-                del self.storage[key][field]
-                self._save_storage()
+        fields = self.hashes.get(key)
+        if fields is not None and field in fields:
+            record = self._record('hdel', key, field)
+            del fields[field]
+            self._log(record)
 
+    @_writer
     def hincrby(self, key, field, increment):
-        with self.lock:
-            if key not in self.storage:
-                self.storage[key] = {}
-            if field not in self.storage[key]:
-                self.storage[key][field] = 0
-            self.storage[key][field] += increment
-            self._save_storage()
-            return self.storage[key][field]
-
+        _check_member(key, field)
+        record = self._record('hincrby', key, field, increment)
+        fields = self._typed(key, _T_HASH, dict)
+        value = fields[field] = fields.get(field, 0) + increment
+        self._log(record)
+        return value
+
+    def _deque(self, key):
+        """Return the list at ``key`` as a deque, converting a plain list (from disk or set()) once."""
+        values = self._typed(key, _T_LIST, deque)
+        if isinstance(values, list):
+            values = self.lists[key] = deque(values)
+        return values
+
+    @_writer
     def lpush(self, key, value):
-        with self.lock:
-            if key not in self.storage:
-                self.storage[key] = []
-            elif not isinstance(self.storage[key], list):
-                raise TypeError(f"The value for key '{key}' is not a list.")
-            self.storage[key].insert(0, value)
-            self._save_storage()
+        record = self._record('lpush', key, value)
+        self._deque(key).appendleft(value)
+        self._log(record)
 
+    @_writer
     def rpush(self, key, value):
-        with self.lock:
-            if key not in self.storage:
-                self.storage[key] = []
-            elif not isinstance(self.storage[key], list):
-                raise TypeError(f"The value for key '{key}' is not a list.")
-            self.storage[key].append(value)
-            self._save_storage()
+        record = self._record('rpush', key, value)
+        self._deque(key).append(value)
+        self._log(record)
 
+    @_writer
     def lpop(self, key):
-        with self.lock:
-            if key in self.storage and isinstance(self.storage[key], list) and self.storage[key]:
-                value = self.storage[key].pop(0)
-                self._save_storage()
-                return value
-            return None
-
+        if self.lists.get(key):
+            record = self._record('lpop', key)
+            value = self._deque(key).popleft()
+            self._log(record)
+            return value
+        return None
+
+    @_writer
     def rpop(self, key):
-        with self.lock:
-            if key in self.storage and isinstance(self.storage[key], list) and self.storage[key]:
-                value = self.storage[key].pop()
-                self._save_storage()
-                return value
-            return None
+        values = self.lists.get(key)
+        if values:
+            record = self._record('rpop', key)
+            value = values.pop()
+            self._log(record)
+            return value
+        return None
 
     def llen(self, key):
-        with self.lock:
-            if key in self.storage and isinstance(self.storage[key], list):
-                return len(self.storage[key])
-            return 0
+        values = self.lists.get(key)
+        return len(values) if values is not None else 0
 
     def expire(self, key, ttl):
-        with self.lock:
-            if key in self.storage:
-                if isinstance(self.storage[key], dict) and 'expires_at' in self.storage[key]:
-                    self.storage[key]['expires_at'] = time.time() + ttl
-                else:
-                    self.storage[key] = {'value': self.storage[key], 'expires_at': time.time() + ttl}
-                self._save_storage()
+        return self.expireat(key, time.time() + ttl)
 
-    def keys(self, pattern='*'):
-        with self.lock:
-            return [key for key in self.storage.keys() if fnmatch.fnmatch(key, pattern)]
+    @_writer
+    def expireat(self, key, timestamp):
+        if key in self._type:
+            record = self._record('expireat', key, timestamp)
+            self.ttl[key] = timestamp
+            self._schedule_expiry(key, timestamp)
+            self._log(record)
 
+    def keys(self, pattern='*'):
+        with self._locked():
+            if pattern == '*':
+                return list(self._type)
+            prefix = pattern.rstrip('*')
+            if not any(char in prefix for char in '*?['):
+                if prefix == pattern:
+                    return [pattern] if pattern in self._type else []
+                # 'prefix:*' is a range scan over the sorted key index.
+                if self._keys_sorted is None:
+                    self._keys_sorted = sorted(self._type)
+                start = bisect.bisect_left(self._keys_sorted, prefix)
+                return list(itertools.takewhile(lambda key: key.startswith(prefix), itertools.islice(self._keys_sorted, start, None)))
+            # filter() drives the loop in C; only the regex match itself runs per key.
+            return list(filter(_glob_matcher(pattern), self._type))
+
+    @_writer
     def incrby(self, key, increment):
-        with self.lock:
-            if key not in self.storage:
-                self.storage[key] = 0
-            if not isinstance(self.storage[key], int):
-                raise TypeError(f"The value for key '{key}' is not an integer.")
-            self.storage[key] += increment
-            self._save_storage()
-            return self.storage[key]
+        record = self._record('incrby', key, increment)
+        value = self.ints[key] = self._typed(key, _T_INTEGER, int) + increment
+        self._log(record)
+        return value
 
     def decrby(self, key, decrement):
         return self.incrby(key, -decrement)
 
     def exists(self, key):
-        with self.lock:
-            return key in self.storage
+        return key in self._type
 
     def rename(self, old_key, new_key):
-        with self.lock:
-            if old_key in self.storage:
-                self.storage[new_key] = self.storage.pop(old_key)
-                self._save_storage()
-            else:
+        with self._locked(old_key, new_key, write=True):
+            kind = self._type.get(old_key)
+            if kind is None:
                 raise KeyError(f"The key '{old_key}' does not exist.")
+            record = self._record('rename', old_key, new_key)
+            value = self._shards[kind][old_key]
+            expires_at = self.ttl.get(old_key)
+            self._drop(old_key)
+            self._put(new_key, kind, value)
+            if expires_at is not None:
+                self.ttl[new_key] = expires_at
+                # The heap entry names the old key.
+                self._schedule_expiry(new_key, expires_at)
+            self._log(record)
 
     def type(self, key):
-        with self.lock:
-            if key in self.storage:
-                value = self.storage[key]
-                if isinstance(value, str):
-                    return 'string'
-                elif isinstance(value, list):
-                    return 'list'
-                elif isinstance(value, set):
-                    return 'set'
-                elif isinstance(value, dict):
-                    return 'hash'
-                elif isinstance(value, int):
-                    return 'integer'
-                else:
-                    return 'unknown'
-            return 'none'
+        kind = self._type.get(key)
+        return 'none' if kind is None else _TYPE_NAMES[kind]
 
+    @_writer
     def append(self, key, value):
-        with self.lock:
-            if key in self.storage:
-                if isinstance(self.storage[key], str):
-                    self.storage[key] += value
-                else:
-                    raise TypeError(f"The value for key '{key}' is not a string.")
-            else:
-                self.storage[key] = value
-            self._save_storage()
+        record = self._record('append', key, value)
+        kind = self._type.get(key)
+        if kind is None:
+            self._put(key, _T_STRING, value)
+        elif kind == _T_STRING:
+            self.strings[key] += value
+        else:
+            raise TypeError(f"The value for key '{key}' is not a string.")
+        self._log(record)
 
     def lindex(self, key, index):
-        with self.lock:
-            if key in self.storage and isinstance(self.storage[key], list):
-                try:
-                    return self.storage[key][index]
-                except IndexError:
-                    return None
-            return None
-
+        values = self.lists.get(key)
+        if values is not None:
+            try:
+                return values[index]
+            except IndexError:
+                return None
+        return None
+
+    @_reader
     def lrange(self, key, start, end):
-        with self.lock:
-            if key in self.storage and isinstance(self.storage[key], list):
-                return self.storage[key][start:end + 1]
-            return []
+        values = self.lists.get(key)
+        if values is not None:
+            # Same bounds as values[start:end + 1], but deques cannot be sliced.
+            first, stop, _ = slice(start, end + 1).indices(len(values))
+            return list(itertools.islice(values, first, max(first, stop)))
+        return []
 
     def scard(self, key):
-        with self.lock:
-            if key in self.storage and isinstance(self.storage[key], set):
-                return len(self.storage[key])
-            return 0
+        members = self.sets.get(key)
+        return len(members) if members is not None else 0
 
     def sdiff(self, key1, key2):
-        with self.lock:
-            if key1 in self.storage and key2 in self.storage and isinstance(self.storage[key1], set) and isinstance(self.storage[key2], set):
-                return self.storage[key1] - self.storage[key2]
+        with self._locked(key1, key2):
+            members1, members2 = self.sets.get(key1), self.sets.get(key2)
+            if members1 is not None and members2 is not None:
+                return members1 - members2
             return set()
 
     def sunion(self, key1, key2):
-        with self.lock:
-            if key1 in self.storage and key2 in self.storage and isinstance(self.storage[key1], set) and isinstance(self.storage[key2], set):
-                return self.storage[key1] | self.storage[key2]
+        with self._locked(key1, key2):
+            members1, members2 = self.sets.get(key1), self.sets.get(key2)
+            if members1 is not None and members2 is not None:
+                return members1 | members2
             return set()
 
+    def sdiff_iter(self, key1, key2):
+        """Like sdiff(), but yields the members instead of returning a new set.
+
+        The members are collected under the keys' read locks, which are released
+        before the first one is yielded, so the caller may read and write freely
+        while iterating.
+        """
+        with self._locked(key1, key2):
+            members1, members2 = self.sets.get(key1), self.sets.get(key2)
+            if members1 is None or members2 is None:
+                return
+            members = [member for member in members1 if member not in members2]
+        yield from members
+
+    def sunion_iter(self, key1, key2):
+        """Like sunion(), but yields the members instead of returning a new set; see sdiff_iter()."""
+        with self._locked(key1, key2):
+            members1, members2 = self.sets.get(key1), self.sets.get(key2)
+            if members1 is None or members2 is None:
+                return
+            # Copy the larger set whole and probe it only with the smaller one's members.
+            large, small = (members1, members2) if len(members1) >= len(members2) else (members2, members1)
+            extra = [member for member in small if member not in large]
+            large = tuple(large)
+        yield from large
+        yield from extra
+
+    @_reader
     def hkeys(self, key):
-        with self.lock:
-            if key in self.storage and isinstance(self.storage[key], dict):
-                return list(self.storage[key].keys())
-            return []
+        fields = self.hashes.get(key)
+        return list(fields.keys()) if fields is not None else []
 
+    @_reader
     def hvals(self, key):
-        with self.lock:
-            if key in self.storage and isinstance(self.storage[key], dict):
-                return list(self.storage[key].values())
-            return []
+        fields = self.hashes.get(key)
+        return list(fields.values()) if fields is not None else []
 
     def hlen(self, key):
-        with self.lock:
-            if key in self.storage and isinstance(self.storage[key], dict):
-                return len(self.storage[key])
-            return 0
+        fields = self.hashes.get(key)
+        return len(fields) if fields is not None else 0
 
+    @_writer
     def zadd(self, key, score, value):
-        with self.lock:
-            if key not in self.storage:
-                self.storage[key] = []
-            self.storage[key].append((score, value))
-            self.storage[key].sort()
-            self._save_storage()
+        _check_member(key, value)
+        record = self._record('zadd', key, score, value)
+        self._typed(key, _T_ZSET, SortedSet).add(score, value)
+        self._log(record)
 
+    @_reader
     def zrange(self, key, start, end):
-        with self.lock:
-            if key in self.storage and isinstance(self.storage[key], list):
-                return [v for s, v in self.storage[key][start:end + 1]]
-            return []
+        zset = self.zsets.get(key)
+        return zset.range(start, end) if zset is not None else []
 
     def zscore(self, key, value):
-        with self.lock:
-            if key in self.storage and isinstance(self.storage[key], list):
-                for score, val in self.storage[key]:
-                    if val == value:
-                        return score
-            return None
-
+        zset = self.zsets.get(key)
+        return zset.score(value) if zset is not None else None
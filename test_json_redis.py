@@ -0,0 +1,526 @@
+import os
+import sys
+import time
+import json
+import shutil
+import tempfile
+import textwrap
+import threading
+import subprocess
+import unittest
+
+from json_redis import JSONStorage
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+class StorageTestCase(unittest.TestCase):
+    fmt = 'json'
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir, ignore_errors=True)
+        self.filename = os.path.join(self.dir, 'storage.json')
+
+    def open(self, **kwargs):
+        kwargs.setdefault('fmt', self.fmt)
+        db = JSONStorage(self.filename, **kwargs)
+        self.addCleanup(db.close)
+        return db
+
+    def crash(self, script, appendfsync='always'):
+        """Run ``script`` against ``db`` in a child process that dies without closing the store."""
+        code = ('import os, sys, time\n'
+                'from json_redis import JSONStorage\n'
+                f'db = JSONStorage(sys.argv[1], appendfsync={appendfsync!r}, fmt={self.fmt!r})\n'
+                + textwrap.dedent(script) +
+                # Otherwise give the background thread a tick to write the log out.
+                ('' if appendfsync == 'always' else '\ntime.sleep(1.5)') +
+                '\nos._exit(0)\n')
+        subprocess.run([sys.executable, '-c', code, self.filename], cwd=HERE, check=True)
+
+
+FILL = '''
+db.set('str', 'text')
+db.set('members', {1, 'two'})
+db.incrby('counter', 5)
+db.rpush('queue', 'a')
+db.lpush('queue', 'b')
+db.hset('hash', 'field', [1, 2])
+db.hincrby('hash', 'hits', 2)
+db.zadd('scores', 2, 'x')
+db.zadd('scores', 1, 'y')
+db.setex('later', 3600, 'soon')
+db.setex('expired', -1, 'gone')
+'''
+
+
+class PersistenceTests(StorageTestCase):
+    def check(self, db):
+        self.assertEqual(db.get('str'), 'text')
+        self.assertEqual(db.type('members'), 'set')
+        self.assertEqual(db.smembers('members'), {1, 'two'})
+        self.assertEqual(db.get('counter'), 5)
+        self.assertEqual(db.lrange('queue', 0, 10), ['b', 'a'])
+        self.assertEqual(db.hget('hash', 'field'), [1, 2])
+        self.assertEqual(db.hget('hash', 'hits'), 2)
+        self.assertEqual(db.zrange('scores', 0, 10), ['y', 'x'])
+        self.assertEqual(db.get('later'), 'soon')
+        self.assertIsNone(db.get('expired'))
+
+    def test_replay_after_crash(self):
+        self.crash(FILL)
+        self.check(self.open())
+
+    def test_reopen_after_close(self):
+        db = self.open()
+        exec(FILL, {'db': db})
+        db.close()
+        self.check(self.open())
+
+    def test_torn_log_record(self):
+        # Cut the last record short inside its payload, then inside its length prefix.
+        for cut in (3, 7):
+            with self.subTest(cut=cut):
+                self.crash(f"db.set('a', {cut})\ndb.set('b', {cut})")
+                size = os.path.getsize(self.filename + '.aof')
+                with open(self.filename + '.aof', 'rb+') as file:
+                    file.truncate(size - cut)
+                # The next writer must not strand its records behind the torn one.
+                self.crash(f"db.set('c', {cut})")
+                db = self.open()
+                self.assertEqual((db.get('a'), db.get('b'), db.get('c')), (cut, None, cut))
+                db.close()
+
+    def test_torn_log_header(self):
+        self.crash("db.set('a', 1)")
+        with open(self.filename + '.aof', 'rb+') as file:
+            file.truncate(4)
+        self.assertEqual(self.open().get('a'), None)
+        self.crash("db.set('b', 2)")
+        self.assertEqual(self.open().get('b'), 2)
+
+    def test_log_not_replayed_over_its_compaction(self):
+        self.crash("db.incrby('c', 1)\ndb.lpush('l', 'a')")
+        shutil.copy(self.filename + '.aof', self.filename + '.old')
+        db = self.open()
+        db.set('x', 0)
+        db.close()
+        # The compaction reached disk but the log truncation did not.
+        os.replace(self.filename + '.old', self.filename + '.aof')
+        db = self.open()
+        self.assertEqual(db.get('c'), 1)
+        self.assertEqual(db.lrange('l', 0, 10), ['a'])
+
+    def test_patches_over_snapshot(self):
+        db = self.open()
+        db.set('a', 1)
+        db.sadd('s', 1)
+        db.close()
+        self.crash("db.delete('a')\ndb.sadd('s', 'two')\ndb.incrby('c', 1)")
+        shutil.copy(self.filename + '.aof', self.filename + '.old')
+        db = self.open()
+        db.set('x', 0)
+        db.close()
+        self.assertTrue(os.path.exists(self.filename + '.part'))
+        # The patch reached disk but the log truncation did not.
+        os.replace(self.filename + '.old', self.filename + '.aof')
+        db = self.open()
+        self.assertEqual((db.get('a'), db.get('c')), (None, 1))
+        self.assertEqual(db.smembers('s'), {1, 'two'})
+
+    def test_stale_patches_ignored(self):
+        db = self.open()
+        db.set('a', 1)
+        db.close()
+        db = self.open()
+        db.set('blob', 'x' * 2000)
+        db.delete('a')
+        db.close()
+        shutil.copy(self.filename + '.part', self.filename + '.old')
+        # The patches now outgrow the snapshot, so this compaction rewrites it.
+        db = self.open()
+        db.set('a', 2)
+        db.close()
+        self.assertFalse(os.path.exists(self.filename + '.part'))
+        # The new snapshot reached disk but the patch file was never removed.
+        os.replace(self.filename + '.old', self.filename + '.part')
+        db = self.open()
+        self.assertEqual(db.get('a'), 2)
+
+    def test_torn_patch(self):
+        db = self.open()
+        db.set('a', 'x' * 1000)
+        db.close()
+        db = self.open()
+        db.set('b', 2)
+        db.close()
+        with open(self.filename + '.part', 'ab') as file:
+            file.write(b'{"base"')
+        db = self.open()
+        self.assertEqual((db.get('a'), db.get('b')), ('x' * 1000, 2))
+        db.set('c', 3)
+        db.close()
+        db = self.open()
+        self.assertEqual((db.get('b'), db.get('c')), (2, 3))
+
+    def test_unstorable_values_rejected(self):
+        db = self.open()
+        for command, args in (('sadd', ('s', (1, 2))), ('zadd', ('z', 1, (1, 2))),
+                              ('hset', ('h', (1, 2), 'v')), ('hincrby', ('h', (1, 2), 1)),
+                              ('set', ('d', {(1, 2): 'v'})), ('set', ('o', object())),
+                              ('set', ('b', b'raw')), ('rpush', ('l', range(3)))):
+            with self.subTest(command), self.assertRaises(TypeError):
+                getattr(db, command)(*args)
+        self.assertEqual(db.keys(), [])
+        db.close()
+        self.assertEqual(self.open().keys(), [])
+
+    def test_integers_beyond_64_bits(self):
+        self.crash("db.incrby('big', 2 ** 70)\ndb.hset('h', 'f', -2 ** 64)")
+        db = self.open()
+        self.assertEqual((db.get('big'), db.hget('h', 'f')), (2 ** 70, -2 ** 64))
+        self.assertEqual(db.incrby('big', 1), 2 ** 70 + 1)
+        db.close()
+        db = self.open()
+        self.assertEqual((db.get('big'), db.hget('h', 'f')), (2 ** 70 + 1, -2 ** 64))
+
+    def test_appendfsync_policies(self):
+        for policy in ('always', 'everysec', 'no'):
+            with self.subTest(policy):
+                self.crash(f"db.set({policy!r}, 1)", appendfsync=policy)
+                db = self.open()
+                self.assertEqual(db.get(policy), 1)
+                db.close()
+        with self.assertRaises(ValueError):
+            JSONStorage(self.filename, appendfsync='sometimes')
+
+    def test_failed_compaction_refuses_writes_until_it_recovers(self):
+        db = self.open(snapshot_ops=1)
+        # The snapshot is written aside first; a directory in the way makes that fail.
+        os.mkdir(self.filename + '.tmp')
+        db.set('a', 1)
+        with self.assertRaises(RuntimeError):
+            for _ in range(50):
+                time.sleep(0.1)
+                db.set('b', 2)
+        os.rmdir(self.filename + '.tmp')
+        for _ in range(50):
+            time.sleep(0.1)
+            try:
+                db.set('b', 2)
+                break
+            except RuntimeError:
+                pass
+        else:
+            self.fail('writes were still refused after the failure cleared')
+        db.close()
+        db = self.open()
+        self.assertEqual((db.get('a'), db.get('b')), (1, 2))
+
+    def test_unversioned_snapshot(self):
+        with open(self.filename, 'w') as file:
+            json.dump({'s': 'text', 'members': [1, 2], 'h': {'f': 'v'},
+                       't': {'value': 'x', 'expires_at': 9999999999}}, file)
+        db = self.open()
+        self.assertEqual(db.get('s'), 'text')
+        self.assertEqual(db.smembers('members'), {1, 2})
+        self.assertEqual(db.hget('h', 'f'), 'v')
+        self.assertEqual(db.get('t'), 'x')
+        db.set('n', 1)
+        db.close()
+        db = self.open()
+        self.assertEqual((db.get('s'), db.get('n')), ('text', 1))
+
+
+class PicklePersistenceTests(PersistenceTests):
+    fmt = 'pickle'
+
+    def test_switch_format(self):
+        for fmt in ('json', 'pickle', 'json'):
+            with self.subTest(fmt=fmt):
+                db = self.open(fmt=fmt)
+                db.set(fmt, 1)
+                db.close()
+                # The second store starts from a snapshot, so it also leaves a patch behind.
+                db = self.open(fmt=fmt)
+                db.rpush('list', fmt)
+                db.close()
+        db = self.open()
+        self.assertEqual((db.get('json'), db.get('pickle')), (1, 1))
+        self.assertEqual(db.get('list'), ['json', 'pickle', 'json'])
+
+
+class CommandTests(StorageTestCase):
+    def test_list_pushes_and_pops(self):
+        db = self.open()
+        db.set('l', [2, 3])
+        db.lpush('l', 1)
+        db.rpush('l', 4)
+        db.rpush('new', 'a')
+        self.assertEqual(db.get('l'), [1, 2, 3, 4])
+        self.assertEqual(db.type('l'), 'list')
+        self.assertEqual((db.llen('l'), db.lindex('l', -1)), (4, 4))
+        self.assertEqual(db.lrange('l', 1, 2), [2, 3])
+        self.assertEqual(db.lrange('l', -2, 10), [3, 4])
+        self.assertEqual(db.lrange('l', 3, 1), [])
+        self.assertEqual((db.lpop('l'), db.rpop('l'), db.lpop('new'), db.lpop('new')), (1, 4, 'a', None))
+        db.close()
+        db = self.open()
+        self.assertEqual(db.get('l'), [2, 3])
+        db.set('s', 'text')
+        with self.assertRaises(TypeError):
+            db.rpush('s', 'x')
+
+
+    def test_sorted_sets(self):
+        db = self.open()
+        db.zadd('z', 3, 'a')
+        db.zadd('z', 1, 'b')
+        db.zadd('z', 2, 7)
+        db.zadd('z', 4, 'b')
+        self.assertEqual(db.zrange('z', 0, 10), [7, 'a', 'b'])
+        self.assertEqual((db.zscore('z', 'b'), db.zscore('z', 'missing')), (4, None))
+        self.assertEqual(db.get('z'), [(2, 7), (3, 'a'), (4, 'b')])
+        self.assertEqual(db.type('z'), 'zset')
+        # Members that cannot be ordered against each other leave the set as it was.
+        for score, member in ((3, 5), (2, 'b')):
+            with self.subTest(member=member), self.assertRaises(TypeError):
+                db.zadd('z', score, member)
+        self.assertEqual(db.zrange('z', 0, 10), [7, 'a', 'b'])
+        self.assertEqual((db.zscore('z', 5), db.zscore('z', 'b')), (None, 4))
+        db.set('pairs', [[1, 'x']])
+        with self.assertRaises(TypeError):
+            db.zadd('pairs', 1, 'y')
+        db.close()
+        db = self.open()
+        self.assertEqual(db.zrange('z', 0, 10), [7, 'a', 'b'])
+        self.assertEqual((db.type('z'), db.type('pairs')), ('zset', 'list'))
+
+    def test_unversioned_sorted_set(self):
+        with open(self.filename, 'w') as file:
+            json.dump({'z': [[1, 'a'], [2, 'b']]}, file)
+        db = self.open()
+        self.assertEqual(db.zrange('z', 0, 10), ['a', 'b'])
+        self.assertEqual(db.zscore('z', 'b'), 2)
+
+
+    def wait_gone(self, db, key):
+        for _ in range(50):
+            if not db.exists(key):
+                return
+            time.sleep(0.1)
+        self.fail(f'{key!r} outlived its TTL')
+
+    def test_expired_keys_swept(self):
+        db = self.open()
+        db.setex('short', 0.2, 'x')
+        db.set('moved', 'y')
+        db.expire('moved', 3600)
+        db.expire('moved', 0.2)
+        db.setex('kept', 3600, 'z')
+        self.wait_gone(db, 'short')
+        self.wait_gone(db, 'moved')
+        self.assertEqual(db.keys(), ['kept'])
+        db.close()
+        self.assertEqual(self.open().keys(), ['kept'])
+
+    def test_rename_keeps_ttl(self):
+        db = self.open()
+        db.setex('a', 3600, 'long')
+        db.setex('b', 0.3, 'short')
+        db.rename('a', 'c')
+        db.rename('b', 'd')
+        self.assertEqual((db.get('c'), db.get('d')), ('long', 'short'))
+        self.wait_gone(db, 'd')
+        db.close()
+        db = self.open()
+        self.assertEqual(db.get('c'), 'long')
+        self.assertFalse(db.exists('d'))
+
+
+    def test_keys_patterns(self):
+        db = self.open()
+        for key in ('user:2', 'users', 'admin', 'user:1'):
+            db.set(key, 1)
+        self.assertEqual(db.keys('user:*'), ['user:1', 'user:2'])
+        db.sadd('user:3', 'x')
+        db.delete('user:1')
+        db.rename('admin', 'user:0')
+        self.assertEqual(db.keys('user:*'), ['user:0', 'user:2', 'user:3'])
+        self.assertEqual(db.keys('user*'), ['user:0', 'user:2', 'user:3', 'users'])
+        self.assertEqual((db.keys('users'), db.keys('user')), (['users'], []))
+        self.assertEqual(db.keys('*s'), ['users'])
+        self.assertEqual(sorted(db.keys()), ['user:0', 'user:2', 'user:3', 'users'])
+
+    def test_keys_globs(self):
+        db = self.open()
+        for key in ('a:1', 'b:12', 'c:1', 'a:x'):
+            db.set(key, 1)
+        self.assertEqual(sorted(db.keys('[ab]:?')), ['a:1', 'a:x'])
+        self.assertEqual(sorted(db.keys('*:1*')), ['a:1', 'b:12', 'c:1'])
+        db.delete('c:1')
+        db.set('d:10', 1)
+        self.assertEqual(sorted(db.keys('[ab]:?')), ['a:1', 'a:x'])
+        self.assertEqual(sorted(db.keys('*:1*')), ['a:1', 'b:12', 'd:10'])
+        self.assertEqual(db.keys('*z*'), [])
+
+
+    def test_types(self):
+        class Text(str):
+            pass
+
+        db = self.open()
+        values = {'s': 'text', 'i': 1, 'l': [1], 'e': set(), 'h': {'f': 1}, 'f': 3.5, 'n': None,
+                  'b': True, 't': Text('sub')}
+        for key, value in values.items():
+            db.set(key, value)
+        db.zadd('z', 1, 'a')
+        expected = {'s': 'string', 'i': 'integer', 'l': 'list', 'e': 'set', 'h': 'hash',
+                    'f': 'unknown', 'n': 'unknown', 'b': 'integer', 't': 'string', 'z': 'zset',
+                    'missing': 'none'}
+        self.assertEqual({key: db.type(key) for key in expected}, expected)
+        for command, args in (('append', ('f', 'x')), ('append', ('l', 'x')), ('incrby', ('s', 1)),
+                              ('hset', ('s', 'f', 1)), ('rpush', ('h', 1)), ('sadd', ('n', 1))):
+            with self.subTest(command=command, key=args[0]), self.assertRaises(TypeError):
+                getattr(db, command)(*args)
+        # A key written with another type moves to that type.
+        db.set('l', 'now a string')
+        self.assertEqual((db.type('l'), db.llen('l'), db.get('l')), ('string', 0, 'now a string'))
+        expected['l'] = 'string'
+        db.close()
+        db = self.open()
+        self.assertEqual({key: db.type(key) for key in expected}, expected)
+        self.assertEqual((db.get('f'), db.get('n')), (3.5, None))
+
+    def test_ttl_on_containers(self):
+        db = self.open()
+        db.hset('h', 'a', 1)
+        db.expire('h', 3600)
+        db.hset('h', 'b', 2)
+        db.sadd('s', 1)
+        db.expire('s', 3600)
+        self.assertEqual((db.hget('h', 'b'), db.get('h'), db.sismember('s', 1)), (2, {'a': 1, 'b': 2}, True))
+        db.set('h', 'plain')
+        db.close()
+        self.crash("db.expire('s', 0.2)")
+        time.sleep(0.3)
+        db = self.open()
+        self.assertEqual((db.get('h'), db.get('s')), ('plain', None))
+
+
+    def test_execute(self):
+        self.crash('''
+            db.execute([('set', 'a', 1), ('incrby', 'a', 2), ('rpush', 'l', 'x')])
+            try:
+                with db.pipeline():
+                    db.set('b', 1)
+                    with db.pipeline():
+                        db.incrby('b', 1)
+                    db.hset('b', 'f', 1)
+            except TypeError:
+                pass
+        ''')
+        db = self.open()
+        self.assertEqual((db.get('a'), db.get('l'), db.get('b')), (3, ['x'], 2))
+        self.assertEqual(db.execute([('incrby', 'a', 1), ('get', 'a'), ('exists', 'b'), ('lpop', 'l'), ('lpop', 'l')]),
+                         [4, 4, True, 'x', None])
+
+
+class ConcurrencyTests(StorageTestCase):
+    def test_concurrent_commands(self):
+        db = self.open()
+        seen = []
+
+        def work():
+            for _ in range(500):
+                db.incrby('n', 1)
+                db.setex('t', 3600, 'x')
+                seen.append(db.get('n'))
+
+        threads = [threading.Thread(target=work) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(db.get('n'), 2000)
+        self.assertEqual(max(seen), 2000)
+        self.assertEqual(db.get('t'), 'x')
+
+    def test_multi_key_commands_do_not_deadlock(self):
+        db = self.open()
+        for n in range(8):
+            db.sadd(f'a{n}', n)
+
+        def work(n):
+            for _ in range(200):
+                db.rename(f'a{n}', f'b{n}')
+                db.sunion(f'b{n}', f'a{(n + 1) % 8}')
+                db.rename(f'b{n}', f'a{n}')
+                db.keys()
+
+        threads = [threading.Thread(target=work, args=(n,)) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(30)
+            self.assertFalse(thread.is_alive())
+        self.assertEqual(sorted(db.keys()), [f'a{n}' for n in range(8)])
+
+    def test_pipeline_is_not_interleaved(self):
+        db = self.open()
+        writer = threading.Thread(target=db.set, args=('other', 1))
+        with db.pipeline():
+            db.set('mine', 1)
+            writer.start()
+            time.sleep(0.2)
+            self.assertFalse(db.exists('other'))
+            db.incrby('mine', 1)
+        writer.join()
+        self.assertEqual((db.get('mine'), db.get('other')), (2, 1))
+
+    def test_set_iterators_release_their_locks(self):
+        db = self.open()
+        for n in range(100):
+            db.sadd('a', n)
+            if n % 3:
+                db.sadd('b', n)
+        db.setex('gone', 0.01, 1)
+        time.sleep(0.05)
+        union = set()
+
+        def work():
+            for member in db.sunion_iter('a', 'b'):
+                union.add(member)
+                # Reads, expiry and writes on the iterated keys must not wait for the generator.
+                db.get('gone')
+                db.sadd('b', -member)
+
+        thread = threading.Thread(target=work, daemon=True)
+        thread.start()
+        thread.join(30)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(union, set(range(100)))
+        self.assertEqual(list(db.sdiff_iter('a', 'missing')), [])
+        self.assertEqual(set(db.sdiff_iter('a', 'b')), db.sdiff('a', 'b'))
+        self.assertEqual(set(db.sunion_iter('b', 'a')), db.sunion('a', 'b'))
+
+    def test_point_reads_do_not_wait_for_writers(self):
+        db = self.open()
+        db.sadd('s', 'a')
+        db.hset('h', 'f', 1)
+        results = []
+
+        def read():
+            results.append((db.exists('s'), db.type('h'), db.sismember('s', 'a'), db.scard('s'), db.hget('h', 'f')))
+
+        reader = threading.Thread(target=read)
+        with db.pipeline():
+            reader.start()
+            reader.join(5)
+            self.assertFalse(reader.is_alive())
+        self.assertEqual(results, [(True, 'hash', True, 1, 1)])
+
+
+if __name__ == '__main__':
+    unittest.main()